@@ -0,0 +1,67 @@
+# config.py
+"""
+Configuration for the Image Captioning API.
+
+Kept free of heavy dependencies (torch, transformers, FastAPI) so that tooling such as prepare_model.py
+can read it without loading the model stack.
+"""
+import hashlib
+import json
+import os
+import re
+
+# Model used for captioning. You can change this to other compatible models.
+# "Salesforce/blip-image-captioning-base" is smaller and faster.
+# "Salesforce/blip-image-captioning-large" provides more detail but is slower.
+MODEL_NAME = "Salesforce/blip-image-captioning-large"
+SUPPORTED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+# Case-insensitive match of any supported extension at the end of a filename, built from SUPPORTED_EXTENSIONS.
+IMAGE_EXTENSION_RE = re.compile(r"(?:%s)\Z" % "|".join(re.escape(ext) for ext in SUPPORTED_EXTENSIONS), re.IGNORECASE)
+
+# Parameters for the caption generation process.
+# The number of beams and the new-token cap dominate per-image latency; both can be tuned
+# with CAPTION_BEAMS and CAPTION_MAX_NEW to trade caption quality for speed.
+GENERATION_ARGS = {
+    "max_new_tokens": int(os.getenv("CAPTION_MAX_NEW", 40)),
+    "num_beams": int(os.getenv("CAPTION_BEAMS", 3)),
+    "early_stopping": True,
+    "repetition_penalty": 1.2,
+    "length_penalty": 1.0,
+    "use_cache": True,  # Reuse the decoder's key/value cache across generation steps.
+}
+
+# When positive, generation stops early once the best beam of every image predicts end-of-sequence with a
+# log-probability at least this many nats above the runner-up token. Opt-in: 0 (the default) disables it.
+EOS_MARGIN = float(os.getenv("CAPTION_EOS_MARGIN", 0))
+
+# Fingerprint of the generation parameters. Part of every caption cache key so that changing
+# GENERATION_ARGS or EOS_MARGIN invalidates previously cached captions.
+GENERATION_ARGS_HASH = hashlib.md5(
+    json.dumps({**GENERATION_ARGS, "eos_margin": EOS_MARGIN}, sort_keys=True).encode()).hexdigest()
+
+# Maximum number of captions kept in the in-memory LRU cache. Set CAPTION_CACHE_SIZE=0 to disable caching.
+CAPTION_CACHE_SIZE = int(os.getenv("CAPTION_CACHE_SIZE", 10000))
+
+# Graph-level optimization applied to the PyTorch model after loading: "none", "bettertransformer"
+# (fused attention kernels via optimum) or "compile" (torch.compile, with CUDA Graphs for the vision encoder).
+MODEL_OPTIMIZATION = os.getenv("CAPTION_MODEL_OPTIMIZATION", "none").lower()
+
+# Optimize the CPU PyTorch model with Intel Extension for PyTorch and run generation under BF16 autocast.
+# Silently skipped when intel_extension_for_pytorch is not installed. Set CAPTION_IPEX=0 to disable.
+IPEX_BF16 = os.getenv("CAPTION_IPEX", "1") == "1"
+
+# Directory holding a local safetensors snapshot of MODEL_NAME (see prepare_model.py). When present, the
+# PyTorch model and processor are loaded from it with zero-copy mmap instead of from the Hugging Face cache.
+MODEL_SNAPSHOT_DIR = os.getenv("CAPTION_MODEL_SNAPSHOT", "blip_st")
+
+# Decoded images are downscaled so their longer side is at most MAX_IMAGE_SIDE before preprocessing.
+# BLIP resizes to 384x384 internally, so this bounds the processor's work without affecting caption quality.
+# JPEGs are additionally decoded at reduced scale by libjpeg (DCT-domain downscaling) down to JPEG_DRAFT_SIZE.
+MAX_IMAGE_SIDE = 768
+JPEG_DRAFT_SIZE = (512, 512)
+
+# Number of images passed through the model together in a single forward/generate call.
+CAPTION_BATCH_SIZE = int(os.getenv("CAPTION_BATCH", 8))
+
+# Number of preprocessed batches prepared ahead of the batch currently being captioned.
+PREFETCH_BATCHES = 2
@@ -1,35 +1,80 @@
 # main.py
+import asyncio
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from functools import partial
 from fastapi import FastAPI, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import os
-from transformers import pipeline
+import torch
+from transformers import (AutoProcessor, BlipForConditionalGeneration, LogitsProcessor, LogitsProcessorList,
+                          StoppingCriteria, StoppingCriteriaList)
 from PIL import Image
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, AsyncIterator, Callable, NamedTuple, Optional
+
+try:
+    # blake3 hashes large image files several times faster than SHA-256; fall back to hashlib when not installed.
+    from blake3 import blake3 as content_hash
+except ImportError:
+    content_hash = hashlib.sha256
 
 # --- Configuration ---
-# Model used for captioning. You can change this to other compatible models.
-# "Salesforce/blip-image-captioning-base" is smaller and faster.
-# "Salesforce/blip-image-captioning-large" provides more detail but is slower.
-MODEL_NAME = "Salesforce/blip-image-captioning-large"
-SUPPORTED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
-
-# Parameters for the caption generation process
-GENERATION_ARGS = {
-    "max_length": 150,
-    "num_beams": 5,
-    "early_stopping": True,
-    "repetition_penalty": 1.2,
-}
+# All settings live in config.py so that they can be read without importing the model stack.
+from config import (
+    MODEL_NAME, SUPPORTED_EXTENSIONS, IMAGE_EXTENSION_RE, GENERATION_ARGS, EOS_MARGIN, GENERATION_ARGS_HASH,
+    CAPTION_CACHE_SIZE, MODEL_OPTIMIZATION, IPEX_BF16, MODEL_SNAPSHOT_DIR, MAX_IMAGE_SIDE,
+    JPEG_DRAFT_SIZE, CAPTION_BATCH_SIZE, PREFETCH_BATCHES
+)
 
 # --- Logging Setup ---
 # Configures basic logging for the application.
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# --- Global Variable for the Hugging Face Model ---
-# This will hold the initialized image captioning pipeline.
-captioner: Optional[Any] = None
+# --- Global Variables for the Hugging Face Model ---
+# These hold the initialized image processor and captioning model, and where/in which dtype the model runs.
+processor: Optional[Any] = None
+model: Optional[Any] = None
+device: torch.device = torch.device("cpu")
+model_dtype: torch.dtype = torch.float32
+# model.generate with GENERATION_ARGS (and early stopping) bound once at startup, so the per-batch call only
+# passes pixel values. The early-stopping objects are stateful, which is safe because generation runs on
+# a single thread.
+generate_fn: Optional[Callable[..., torch.Tensor]] = None
+# Preallocated (CAPTION_BATCH_SIZE, 3, H, W) input buffers on CUDA hosts: a pinned host staging buffer and its
+# device counterpart. Every batch is copied through them, avoiding per-batch pinned and device allocations.
+# Only touched from the generation thread.
+host_pixel_buffer: Optional[torch.Tensor] = None
+device_pixel_buffer: Optional[torch.Tensor] = None
+# Whether batches are zero-padded to CAPTION_BATCH_SIZE so every generate call sees the same input shape and
+# the vision encoder's CUDA Graphs captured by torch.compile(mode="reduce-overhead") are replayed. Set at startup.
+use_cuda_graphs: bool = False
+# Whether generation runs under CPU BF16 autocast. Set at startup once the model has been optimized with IPEX.
+use_cpu_bf16_autocast: bool = False
+
+# --- Caption Cache ---
+# Maps (image content hash, model, generation parameters) to a previously generated caption, so unchanged
+# images are not re-captioned on repeated requests. Accessed from the I/O thread pool, hence the lock.
+_caption_cache: "OrderedDict[str, str]" = OrderedDict()
+_caption_cache_lock = threading.Lock()
+
+# --- Thread Pool for Image Decoding ---
+# Disk reads, JPEG/PNG decoding and image preprocessing release the GIL, so they run concurrently on this
+# pool instead of serially on the event loop thread.
+_io_pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2), thread_name_prefix="image-io")
+
+# --- Thread for Caption Generation ---
+# Generation runs on a single dedicated thread, one batch at a time, so the event loop stays free to keep
+# preparing the next batches on the I/O pool while the model is busy.
+_generate_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
 
 # --- FastAPI App Initialization ---
 # Creates a new FastAPI application instance.
@@ -46,21 +91,427 @@ class ImageCaptionRequest(BaseModel):
     folder_location: str
 
 
-# Defines the structure for each item in the results list of the response.
+# Defines the structure of each caption line in the NDJSON response stream.
 class ImageCaptionResponseItem(BaseModel):
     image_path: str
     description: str
 
 
-# Defines the overall structure of the JSON response.
+# Defines the structure of the summary line that ends the NDJSON response stream.
 class CaptionSummaryResponse(BaseModel):
     total_images_found: int
     successfully_captioned: int
-    results: List[ImageCaptionResponseItem]
     message: str
     errors: List[str] = []
 
 
+# --- Early Stopping ---
+class LastScoresRecorder(LogitsProcessor):
+    """Keeps the processed next-token log-probabilities of the latest generation step, without modifying them."""
+
+    def __init__(self):
+        self.last_scores: Optional[torch.Tensor] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.last_scores = scores
+        return scores
+
+
+class ConfidentEOSCriteria(StoppingCriteria):
+    """
+    Stops generation for an image once its best running beam predicted the EOS token with a log-probability
+    more than `margin` nats above the next best token, and the best candidate continuation of the step is EOS.
+
+    Beam search (transformers 4.50+) evaluates stopping criteria on the top candidate continuations of each
+    image (at least 2 * num_beams rows per image, sorted by score) rather than on the running beams, and
+    finalizes every candidate that is marked done. Marking all of an image's candidates done at a step whose
+    best candidate ends with EOS therefore keeps that EOS hypothesis ranked first among them and stops the
+    image; the remaining beams would only have been extended to confirm it.
+    """
+
+    def __init__(self, eos_token_id: int, num_beams: int, margin: float, recorder: LastScoresRecorder):
+        self.eos_token_id = eos_token_id
+        self.num_beams = num_beams
+        self.margin = margin
+        self.recorder = recorder
+
+    def __call__(self, input_ids: torch.LongTensor, scores: Optional[torch.FloatTensor], **kwargs) -> torch.BoolTensor:
+        not_done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        last_scores = self.recorder.last_scores
+        if last_scores is None or last_scores.shape[0] % self.num_beams:
+            return not_done
+        num_images = last_scores.shape[0] // self.num_beams
+        if input_ids.shape[0] % num_images:
+            return not_done
+        candidates_per_image = input_ids.shape[0] // num_images
+
+        # Running beams are kept sorted by score, so beam 0 of each image is its best beam.
+        best_beam_scores = last_scores.view(num_images, self.num_beams, last_scores.shape[-1])[:, 0].float()
+        top2 = best_beam_scores.topk(2, dim=-1)
+        confident_eos = (top2.indices[:, 0] == self.eos_token_id) & (top2.values[:, 0] - top2.values[:, 1] > self.margin)
+        # Candidates are sorted by score too, so the first one of each image is its best continuation.
+        best_candidate_is_eos = input_ids.view(num_images, candidates_per_image, -1)[:, 0, -1] == self.eos_token_id
+        # Every candidate of an image shares the image's decision; generation stops once all rows are done.
+        done = confident_eos.to(input_ids.device) & best_candidate_is_eos
+        return done.repeat_interleave(candidates_per_image)
+
+
+def build_early_stopping_kwargs(captioning_model: Any) -> Dict[str, Any]:
+    """
+    Builds the `generate` keyword arguments that enable `ConfidentEOSCriteria`.
+
+    Args:
+        captioning_model: The loaded captioning model.
+
+    Returns:
+        Dict[str, Any]: `logits_processor` and `stopping_criteria` arguments, or an empty dict if
+        EOS_MARGIN is disabled or the model's EOS token cannot be determined.
+    """
+    if EOS_MARGIN <= 0:
+        return {}
+    # BLIP ends captions with the text decoder's [SEP] token rather than the generation config's EOS token.
+    text_config = getattr(captioning_model.config, "text_config", captioning_model.config)
+    eos_token_id = getattr(text_config, "sep_token_id", None)
+    if eos_token_id is None:
+        eos_token_id = getattr(captioning_model.generation_config, "eos_token_id", None)
+    if not isinstance(eos_token_id, int):
+        logger.warning("Could not determine a single EOS token for the model. Confident-EOS early stopping disabled.")
+        return {}
+    recorder = LastScoresRecorder()
+    criteria = ConfidentEOSCriteria(eos_token_id, GENERATION_ARGS["num_beams"], EOS_MARGIN, recorder)
+    logger.info(f"Confident-EOS early stopping enabled (EOS token {eos_token_id}, margin {EOS_MARGIN} nats).")
+    return {"logits_processor": LogitsProcessorList([recorder]), "stopping_criteria": StoppingCriteriaList([criteria])}
+
+
+# --- Model Loading Helpers ---
+def model_source() -> str:
+    """
+    Returns where the PyTorch model and processor are loaded from: the local safetensors snapshot
+    in MODEL_SNAPSHOT_DIR if it exists, otherwise MODEL_NAME on the Hugging Face Hub.
+    """
+    return MODEL_SNAPSHOT_DIR if os.path.isdir(MODEL_SNAPSHOT_DIR) else MODEL_NAME
+
+
+def load_pytorch_model(dtype: torch.dtype) -> Any:
+    """
+    Loads the PyTorch captioning model in the given dtype.
+
+    `low_cpu_mem_usage` materializes the weights directly instead of first allocating a randomly
+    initialized model, and a safetensors snapshot is memory-mapped rather than unpickled.
+
+    Args:
+        dtype (torch.dtype): The dtype of the model weights.
+
+    Returns:
+        The loaded model, on CPU.
+    """
+    source = model_source()
+    logger.info(f"Loading PyTorch model from '{source}'...")
+    return BlipForConditionalGeneration.from_pretrained(source, torch_dtype=dtype, low_cpu_mem_usage=True,
+                                                        use_safetensors=True if source == MODEL_SNAPSHOT_DIR else None)
+
+
+def apply_ipex_optimization(captioning_model: Any) -> Optional[Any]:
+    """
+    Optimizes a CPU PyTorch model with Intel Extension for PyTorch (oneDNN BF16 kernels).
+
+    Args:
+        captioning_model: The loaded captioning model, already on its target device.
+
+    Returns:
+        The optimized model, in which case generation should run under CPU BF16 autocast,
+        or None if IPEX is disabled, not installed or not applicable.
+    """
+    if not IPEX_BF16 or device.type != "cpu":
+        return None
+    try:
+        import intel_extension_for_pytorch as ipex
+    except ImportError:
+        return None
+    try:
+        optimized_model = ipex.optimize(captioning_model.eval(), dtype=torch.bfloat16)
+        logger.info("Optimized the CPU model with Intel Extension for PyTorch (BF16).")
+        return optimized_model
+    except Exception as e:
+        logger.warning(f"Failed to optimize the model with Intel Extension for PyTorch: {e}. Using FP32.")
+        return None
+
+
+@contextmanager
+def inference_context():
+    """
+    Context for running caption generation: disables autograd bookkeeping and, when the model was
+    optimized with IPEX, enables CPU BF16 autocast.
+    """
+    with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_cpu_bf16_autocast):
+        yield
+
+
+def optimize_model(captioning_model: Any, generate_kwargs: Dict[str, Any]) -> Any:
+    """
+    Applies MODEL_OPTIMIZATION to a PyTorch captioning model and warms it up on the generation thread.
+
+    Both BetterTransformer and torch.compile can fail lazily, on the first generation rather than when applied,
+    so the warm-up is part of the optimization. Failures are logged and leave the eager model untouched.
+
+    Args:
+        captioning_model: The loaded captioning model.
+        generate_kwargs (Dict[str, Any]): Keyword arguments bound to `model.generate` for the warm-up.
+
+    Returns:
+        The optimized model, or the original model if no optimization was applied.
+    """
+    global generate_fn, use_cuda_graphs
+    if MODEL_OPTIMIZATION == "none":
+        return captioning_model
+    if MODEL_OPTIMIZATION not in ("bettertransformer", "compile"):
+        logger.warning(f"Unknown model optimization '{MODEL_OPTIMIZATION}'. Using the eager model.")
+        return captioning_model
+
+    optimized_model = captioning_model
+    try:
+        if MODEL_OPTIMIZATION == "bettertransformer":
+            from optimum.bettertransformer import BetterTransformer
+            optimized_model = BetterTransformer.transform(captioning_model, keep_original_model=False)
+        else:
+            # Pad batches to CAPTION_BATCH_SIZE so the vision encoder's CUDA Graphs are replayed for every batch.
+            use_cuda_graphs = device.type == "cuda"
+            # generate() on encoder-decoder captioners calls the vision encoder and text decoder directly rather
+            # than the top-level forward, so compile the forward of each top-level submodule instead. Only the
+            # vision encoder sees a fixed input shape and uses CUDA Graphs ("reduce-overhead"): the text decoder's
+            # KV cache grows every step and BLIP does not support a static cache, so graphs would be recorded for
+            # every sequence length. It is compiled without them.
+            for name, submodule in captioning_model.named_children():
+                mode = "reduce-overhead" if name == "vision_model" else "default"
+                submodule.forward = torch.compile(submodule.forward, mode=mode, fullgraph=False)
+
+        # Warm up on the generation thread itself: compiled graphs and CUDA Graphs are captured per thread.
+        generate_fn = partial(optimized_model.generate, **generate_kwargs)
+        _generate_pool.submit(warm_up_model).result()
+        logger.info(f"Applied model optimization: {MODEL_OPTIMIZATION}.")
+        return optimized_model
+    except Exception as e:
+        logger.warning(f"Failed to apply model optimization '{MODEL_OPTIMIZATION}': {e}. Using the eager model.")
+        if getattr(optimized_model, "use_bettertransformer", False):
+            from optimum.bettertransformer import BetterTransformer
+            captioning_model = BetterTransformer.reverse(optimized_model)
+        for submodule in captioning_model.children():
+            # Drop the compiled instance attribute so the class's eager forward is used again.
+            submodule.__dict__.pop("forward", None)
+        use_cuda_graphs = False
+        return captioning_model
+
+
+def preprocess_images(images: List[Image.Image]) -> torch.Tensor:
+    """
+    Resizes and normalizes a batch of images into one contiguous (N, 3, H, W) tensor on the host.
+    Runs on the I/O thread pool so it overlaps with generation of the previous batch.
+
+    Args:
+        images (List[Image.Image]): The RGB images to preprocess.
+
+    Returns:
+        torch.Tensor: The batched pixel values.
+    """
+    return processor(images=images, return_tensors="pt").pixel_values
+
+
+def allocate_pixel_buffers() -> None:
+    """
+    Preallocates the pinned host and device input buffers used by `generate_from_pixel_values` on CUDA hosts.
+    The buffer shape is taken from the processor's output for a blank image.
+    """
+    global host_pixel_buffer, device_pixel_buffer
+    if device.type != "cuda":
+        return
+    sample = preprocess_images([Image.new("RGB", (384, 384))])
+    host_pixel_buffer = torch.empty((CAPTION_BATCH_SIZE, *sample.shape[1:]), dtype=model_dtype, pin_memory=True)
+    device_pixel_buffer = torch.empty_like(host_pixel_buffer, device=device)
+    logger.info(f"Allocated pinned input buffers of shape {tuple(host_pixel_buffer.shape)}.")
+
+
+def stage_pixel_values(pixel_values: torch.Tensor) -> Optional[torch.Tensor]:
+    """
+    Copies a preprocessed batch into the preallocated device buffer through the pinned host buffer.
+
+    The host-to-device copy is issued asynchronously; it is ordered before generation on the same CUDA stream,
+    and generation synchronizes before returning, so both buffers are free again for the next batch.
+
+    Args:
+        pixel_values (torch.Tensor): Batched pixel values from `preprocess_images`.
+
+    Returns:
+        Optional[torch.Tensor]: The batch on the device (the whole buffer, zero-padded, when CUDA Graphs are in
+        use), or None if there are no buffers or the batch does not fit them.
+    """
+    if device_pixel_buffer is None or pixel_values.shape[1:] != device_pixel_buffer.shape[1:] \
+            or pixel_values.shape[0] > device_pixel_buffer.shape[0]:
+        return None
+    num_images = pixel_values.shape[0]
+    host_pixel_buffer[:num_images].copy_(pixel_values)
+    device_pixel_buffer[:num_images].copy_(host_pixel_buffer[:num_images], non_blocking=True)
+    if use_cuda_graphs:
+        # Pad with blank images up to the fixed batch size so the captured graphs can be replayed.
+        device_pixel_buffer[num_images:].zero_()
+        return device_pixel_buffer
+    return device_pixel_buffer[:num_images]
+
+
+def generate_from_pixel_values(pixel_values: torch.Tensor) -> List[str]:
+    """
+    Generates captions for a preprocessed batch with a single `generate` call.
+
+    The batch is moved to the model's device and dtype before generation, through the preallocated
+    buffers where available. When CUDA Graphs are in use, it is padded to CAPTION_BATCH_SIZE so the
+    captured graphs can be replayed. Runs on the generation thread.
+
+    Args:
+        pixel_values (torch.Tensor): Batched pixel values from `preprocess_images`.
+
+    Returns:
+        List[str]: One caption per image, in the same order.
+    """
+    num_images = pixel_values.shape[0]
+    staged_pixel_values = stage_pixel_values(pixel_values)
+    if staged_pixel_values is not None:
+        pixel_values = staged_pixel_values
+    else:
+        pixel_values = pixel_values.to(device, dtype=model_dtype)
+        if use_cuda_graphs and num_images < CAPTION_BATCH_SIZE:
+            # Pad with blank images up to the fixed batch size; their captions are dropped below.
+            padding = pixel_values.new_zeros((CAPTION_BATCH_SIZE - num_images, *pixel_values.shape[1:]))
+            pixel_values = torch.cat([pixel_values, padding])
+    with inference_context():
+        output_ids = generate_fn(pixel_values=pixel_values)
+    return [text.strip() for text in processor.batch_decode(output_ids[:num_images], skip_special_tokens=True)]
+
+
+def generate_captions(images: List[Image.Image]) -> List[str]:
+    """
+    Generates captions for a batch of images: preprocessing followed by generation.
+
+    Args:
+        images (List[Image.Image]): The RGB images to caption.
+
+    Returns:
+        List[str]: One caption per image, in the same order.
+    """
+    return generate_from_pixel_values(preprocess_images(images))
+
+
+def warm_up_model() -> None:
+    """
+    Runs one caption generation on a blank image so that one-off costs (compilation, kernel selection,
+    memory pool growth) are paid at startup instead of on the first request.
+    """
+    logger.info("Warming up the captioning model...")
+    # CUDA Graphs are recorded on the pass after torch.compile's first warm-up run, so run twice in that case.
+    for _ in range(2 if use_cuda_graphs else 1):
+        generate_captions([Image.new("RGB", (384, 384))])
+    logger.info("Warm-up complete.")
+
+
+# --- Caption Cache Helpers ---
+def get_cached_caption(cache_key: str) -> Optional[str]:
+    """
+    Looks up a caption in the LRU cache, marking it as most recently used.
+
+    Args:
+        cache_key (str): Key built by `make_cache_key`.
+
+    Returns:
+        Optional[str]: The cached caption, or None on a cache miss.
+    """
+    with _caption_cache_lock:
+        caption = _caption_cache.get(cache_key)
+        if caption is not None:
+            _caption_cache.move_to_end(cache_key)
+        return caption
+
+
+def put_cached_caption(cache_key: Optional[str], caption: str) -> None:
+    """
+    Stores a caption in the LRU cache, evicting the least recently used entries beyond CAPTION_CACHE_SIZE.
+
+    Args:
+        cache_key (Optional[str]): Key built by `make_cache_key`, or None when caching is disabled.
+        caption (str): The generated caption.
+    """
+    if CAPTION_CACHE_SIZE <= 0 or cache_key is None:
+        return
+    with _caption_cache_lock:
+        _caption_cache[cache_key] = caption
+        _caption_cache.move_to_end(cache_key)
+        while len(_caption_cache) > CAPTION_CACHE_SIZE:
+            _caption_cache.popitem(last=False)
+
+
+def make_cache_key(data: bytes) -> str:
+    """
+    Builds the caption cache key for the raw bytes of an image file.
+
+    Args:
+        data (bytes): The file contents.
+
+    Returns:
+        str: A key combining the content hash, the model name and the generation parameters.
+    """
+    return f"{content_hash(data).hexdigest()}:{MODEL_NAME}:{GENERATION_ARGS_HASH}"
+
+
+# --- Image Loading Helpers ---
+class LoadedImage(NamedTuple):
+    """
+    Result of loading an image file: its cache key (None when caching is disabled) and either a cached
+    caption or the decoded image.
+    """
+    cache_key: Optional[str]
+    cached_caption: Optional[str]
+    image: Optional[Image.Image]
+
+
+def load_image(path: str) -> LoadedImage:
+    """
+    Reads an image file, checks the caption cache and, on a miss, decodes it to RGB format.
+    When caching is disabled (CAPTION_CACHE_SIZE=0) the file is not hashed. Runs on the I/O thread pool.
+
+    Args:
+        path (str): Path to the image file.
+
+    Returns:
+        LoadedImage: The cache key plus the cached caption (on a hit) or the decoded RGB image (on a miss).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if CAPTION_CACHE_SIZE <= 0:
+        return LoadedImage(None, None, decode_image(data))
+    cache_key = make_cache_key(data)
+    cached_caption = get_cached_caption(cache_key)
+    if cached_caption is not None:
+        return LoadedImage(cache_key, cached_caption, None)
+    return LoadedImage(cache_key, None, decode_image(data))
+
+
+def decode_image(data: bytes) -> Image.Image:
+    """
+    Decodes the raw bytes of an image file to an RGB image no larger than MAX_IMAGE_SIDE.
+
+    Args:
+        data (bytes): The file contents.
+
+    Returns:
+        Image.Image: The decoded RGB image.
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.format == 'JPEG':
+        # Ask libjpeg to decode directly at a reduced scale, avoiding the full-resolution pixel buffer.
+        img.draft('RGB', JPEG_DRAFT_SIZE)
+    img = img.convert("RGB")
+    if max(img.size) > MAX_IMAGE_SIDE:
+        img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.BILINEAR)
+    return img
+
+
 # --- FastAPI Application Event Handlers ---
 @app.on_event("startup")
 async def startup_event():
@@ -69,160 +520,326 @@ async def startup_event():
     Initializes the Hugging Face image captioning model.
     This is done once when the application starts to avoid reloading the model on every request.
     """
-    global captioner
-    logger.info(f"Attempting to initialize Hugging Face pipeline with model: {MODEL_NAME}...")
+    global processor, model, device, model_dtype, generate_fn, host_pixel_buffer, device_pixel_buffer, \
+        use_cpu_bf16_autocast
+    logger.info(f"Attempting to initialize Hugging Face model: {MODEL_NAME}...")
     logger.info("This might take some time, especially for larger models on the first run...")
     try:
-        # Initialize the image-to-text pipeline from Hugging Face Transformers.
-        captioner = pipeline("image-to-text", model=MODEL_NAME)
-        logger.info(f"Pipeline initialized successfully with model: {MODEL_NAME}.")
-        logger.info(f"Pipeline device: {captioner.device}")  # Logs the device (CPU/GPU) the model is running on.
+        # Initialize the image processor and captioning model from Hugging Face Transformers.
+        # On a CUDA host the model is placed on the first GPU with FP16 weights, otherwise it runs on CPU in FP32.
+        model = None
+        if torch.cuda.is_available():
+            try:
+                device, model_dtype = torch.device("cuda", 0), torch.float16
+                model = load_pytorch_model(model_dtype).to(device)
+            except Exception as e:
+                logger.warning(f"Failed to initialize model on GPU with FP16 weights: {e}. Falling back to CPU FP32.")
+                model = None
+        if model is None:
+            device, model_dtype = torch.device("cpu"), torch.float32
+            model = load_pytorch_model(model_dtype)
+        processor = AutoProcessor.from_pretrained(model_source())
+        allocate_pixel_buffers()
+
+        # This is an inference-only service: put the model in eval mode and turn off gradient tracking.
+        # Grad mode is thread-local, so generation threads rely on the inference_mode in inference_context().
+        model.eval()
+        torch.set_grad_enabled(False)
+        ipex_model = apply_ipex_optimization(model)
+        if ipex_model is not None:
+            model, use_cpu_bf16_autocast = ipex_model, True
+        generate_kwargs = {**GENERATION_ARGS, **build_early_stopping_kwargs(model)}
+        model = optimize_model(model, generate_kwargs)
+        generate_fn = partial(model.generate, **generate_kwargs)
+        logger.info(f"Model initialized successfully: {MODEL_NAME}.")
+        logger.info(f"Model device: {device}, dtype: {model_dtype}")  # Logs where (CPU/GPU) and how the model runs.
     except Exception as e:
-        logger.error(f"CRITICAL: Failed to initialize Hugging Face pipeline during startup: {e}")
+        logger.error(f"CRITICAL: Failed to initialize Hugging Face model during startup: {e}")
         logger.error(
             "The API might not function correctly. Ensure model availability and resources (internet, disk space, "
             "memory).")
-        captioner = None  # Ensure captioner is None if initialization fails.
+        model = generate_fn = None  # Ensure model is None if initialization fails.
+        host_pixel_buffer = device_pixel_buffer = None
 
 
-# --- API Endpoint Definition ---
-@app.post("/caption-images/", response_model=CaptionSummaryResponse)
-async def create_captions_for_images_in_folder(request: ImageCaptionRequest):
+# --- Folder Listing Helpers ---
+def list_image_entries(folder_path: str) -> List[os.DirEntry]:
     """
-    FastAPI endpoint to process images in a given folder and generate captions.
+    Lists the files with supported image extensions in a folder. Runs on the I/O thread pool.
+
+    The directory is streamed and filtered in a single pass. Scanning the absolute folder path makes
+    every entry.path absolute, for clarity in the response.
 
     Args:
-        request (ImageCaptionRequest): The request body containing the 'folder_location'.
+        folder_path (str): The folder to list.
 
     Raises:
-        HTTPException:
-            - 503 Service Unavailable: If the captioning model failed to load.
-            - 400 Bad Request: If the provided folder_location is invalid.
-            - 500 Internal Server Error: If there's an issue reading the directory.
+        OSError: If the directory cannot be read.
 
     Returns:
-        CaptionSummaryResponse: A JSON response with captioning results, counts, messages, and errors.
+        List[os.DirEntry]: The image files in the folder.
     """
-    global captioner
-    if captioner is None:
-        logger.error("Captioning model is not available. Initialization might have failed during startup.")
-        raise HTTPException(status_code=503, detail="Captioning service is unavailable. Model not loaded.")
+    with os.scandir(os.path.abspath(folder_path)) as it:
+        return [e for e in it if IMAGE_EXTENSION_RE.search(e.name) and e.is_file()]
 
-    folder_path = request.folder_location
-    logger.info(f"Received request to caption images in folder: {folder_path}")
 
-    if not os.path.isdir(folder_path):
-        logger.error(f"Invalid folder path provided: '{folder_path}' does not exist or is not a directory.")
-        raise HTTPException(status_code=400, detail=f"The folder '{folder_path}' does not exist or is not a directory.")
+# --- Response Streaming Helpers ---
+def to_ndjson_line(item: BaseModel) -> str:
+    """
+    Serializes a response model as a single NDJSON line.
 
-    results: List[ImageCaptionResponseItem] = []
-    errors: List[str] = []
+    Args:
+        item (BaseModel): The model to serialize.
+
+    Returns:
+        str: The JSON encoding of the model followed by a newline.
+    """
+    return json.dumps(jsonable_encoder(item)) + "\n"
 
-    try:
-        all_files_in_dir = os.listdir(folder_path)
-    except OSError as e:
-        logger.error(f"Error listing directory {folder_path}: {e}")
-        raise HTTPException(status_code=500, detail=f"Could not read directory contents: {folder_path}")
 
-    # Filter for files with supported image extensions.
-    image_filenames = [f for f in all_files_in_dir if f.lower().endswith(SUPPORTED_EXTENSIONS)]
-    total_images_found = len(image_filenames)
+def build_summary_message(folder_path: str, total_images_found: int, successfully_captioned_count: int,
+                          errors: List[str]) -> str:
+    """
+    Constructs an informative summary message based on the processing outcome.
 
+    Args:
+        folder_path (str): The folder that was processed, as given in the request.
+        total_images_found (int): Number of images with supported extensions in the folder.
+        successfully_captioned_count (int): Number of images a caption was produced for.
+        errors (List[str]): Errors recorded while processing the folder.
+
+    Returns:
+        str: The summary message.
+    """
     if total_images_found == 0:
-        message = f"No images with supported extensions {SUPPORTED_EXTENSIONS} found in the folder: {folder_path}"
-        logger.info(message)
-        return CaptionSummaryResponse(
-            total_images_found=0,
-            successfully_captioned=0,
-            results=[],
-            message=message,
-            errors=[]
-        )
-
-    logger.info(f"Found {total_images_found} image(s) with supported extensions to process in folder: {folder_path}")
-    logger.info(f"Using generation parameters for captions: {GENERATION_ARGS}")
-
-    for filename in image_filenames:
-        current_image_path_relative = os.path.join(folder_path, filename)
-        # Get absolute path for clarity in response, though relative might also work depending on client.
-        current_image_path_absolute = os.path.abspath(current_image_path_relative)
-        logger.info(f"\n--- Processing image: {filename} ---")
-
-        img: Optional[Image.Image] = None
-        try:
-            logger.info(f"Attempting to load image: {current_image_path_absolute}...")
-            # Open the image file and convert to RGB format.
-            img = Image.open(current_image_path_relative).convert("RGB")
-            logger.info(f"Image '{filename}' loaded successfully. Mode: {img.mode}, Size: {img.size}")
-        except FileNotFoundError:  # Should be rare if os.listdir worked, but defensive.
-            msg = f"Image file not found at '{current_image_path_absolute}'. Skipping."
+        return f"No images with supported extensions {SUPPORTED_EXTENSIONS} found in the folder: {folder_path}"
+    if successfully_captioned_count == total_images_found:
+        message = f"Successfully generated captions for all {total_images_found} found image(s)."
+    elif successfully_captioned_count > 0:
+        message = f"Generated captions for {successfully_captioned_count} out of {total_images_found} found image(s). See errors for details on failures."
+    else:  # Found images, but none succeeded
+        message = f"Attempted to process {total_images_found} image(s), but no captions were successfully generated. See errors for details."
+
+    if not errors and successfully_captioned_count < total_images_found:
+        # This case might indicate an issue in error reporting if some images failed silently.
+        additional_info = " Some images may have failed processing without explicit error messages being captured in the error list."
+        message += additional_info
+        logger.warning(
+            f"Discrepancy: {total_images_found} images found, {successfully_captioned_count} captioned, but no errors recorded.")
+    return message
+
+
+class PreparedChunk(NamedTuple):
+    """A chunk of image files ready for generation, as produced by `prepare_chunks`."""
+    entries: List[os.DirEntry]
+    # Captions already known for this chunk, keyed by path (cache hits).
+    captions: Dict[str, str]
+    errors: List[str]
+    # Files still to be captioned, with their cache keys and preprocessed pixel values (None if there are none).
+    pending_entries: List[os.DirEntry]
+    pending_cache_keys: List[Optional[str]]
+    pixel_values: Optional[torch.Tensor]
+
+
+async def prepare_chunk(chunk: List[os.DirEntry]) -> PreparedChunk:
+    """
+    Reads, cache-checks, decodes and preprocesses one chunk of image files on the I/O thread pool.
+
+    Args:
+        chunk (List[os.DirEntry]): The image files of this chunk.
+
+    Returns:
+        PreparedChunk: Cached captions, load errors and the batched pixel values of the remaining images.
+    """
+    loop = asyncio.get_running_loop()
+    logger.info(f"Loading {len(chunk)} image(s) on the I/O thread pool...")
+    load_outcomes = await asyncio.gather(
+        *[loop.run_in_executor(_io_pool, load_image, entry.path) for entry in chunk],
+        return_exceptions=True
+    )
+
+    captions: Dict[str, str] = {}
+    errors: List[str] = []
+    pending_entries: List[os.DirEntry] = []
+    pending_cache_keys: List[Optional[str]] = []
+    pending_imgs: List[Image.Image] = []
+    for entry, outcome in zip(chunk, load_outcomes):
+        filename = entry.name
+        if isinstance(outcome, FileNotFoundError):  # Should be rare if os.scandir worked, but defensive.
+            msg = f"Image file not found at '{entry.path}'. Skipping."
             logger.error(msg)
             errors.append(f"{filename}: {msg}")
             continue
-        except Exception as e:
-            msg = f"An unexpected error occurred while loading image '{filename}': {e}. Skipping."
+        if isinstance(outcome, BaseException):
+            msg = f"An unexpected error occurred while loading image '{filename}': {outcome}. Skipping."
             logger.error(msg)
             errors.append(f"{filename}: {msg}")
             continue
 
-        if img is None:  # Should ideally be caught by the try-except block above.
+        if outcome.cached_caption is not None:
+            logger.info(f"Using cached caption for '{filename}':\n{outcome.cached_caption}\n")
+            captions[entry.path] = outcome.cached_caption
+            continue
+        if outcome.image is None:  # Should ideally be caught by the exception checks above.
             msg = f"Image object is None after attempting to load '{filename}'. Skipping."
             logger.error(msg)
             errors.append(f"{filename}: {msg}")
             continue
 
-        logger.info(f"Attempting to generate caption for '{filename}'...")
-        try:
-            # Generate caption using the initialized pipeline and generation arguments.
-            captions_output = captioner(img, generate_kwargs=GENERATION_ARGS)
-
-            # The output is typically a list of dictionaries.
-            if captions_output and isinstance(captions_output, list) and len(captions_output) > 0:
-                first_result = captions_output[0]
-                if isinstance(first_result, dict) and 'generated_text' in first_result:
-                    generated_text = first_result['generated_text'].strip()
-                    logger.info(f"Generated Caption for '{filename}':\n{generated_text}\n")
-                    results.append(
-                        ImageCaptionResponseItem(image_path=current_image_path_absolute, description=generated_text))
-                else:
-                    msg = f"Caption output format unexpected for '{filename}'. First element: {first_result}. Skipping."
-                    logger.warning(msg)
-                    errors.append(f"{filename}: {msg}")
-            else:
-                msg = f"Captioner returned empty or None output for '{filename}'. Skipping."
-                logger.warning(msg)
-                errors.append(f"{filename}: {msg}")
+        logger.info(f"Image '{filename}' loaded successfully. Mode: {outcome.image.mode}, Size: {outcome.image.size}")
+        pending_entries.append(entry)
+        pending_cache_keys.append(outcome.cache_key)
+        pending_imgs.append(outcome.image)
 
+    pixel_values: Optional[torch.Tensor] = None
+    if pending_imgs:
+        try:
+            pixel_values = await loop.run_in_executor(_io_pool, preprocess_images, pending_imgs)
         except Exception as e:
-            msg = f"An error occurred during caption generation for '{filename}': {e}."
-            logger.error(msg, exc_info=True)  # Log the full stack trace for debugging.
-            errors.append(f"{filename}: {msg}")
-            continue  # Continue to the next image.
+            logger.error(f"An error occurred while preprocessing images: {e}.", exc_info=True)
+            for entry in pending_entries:
+                errors.append(f"{entry.name}: An error occurred while preprocessing '{entry.name}': {e}.")
+            pending_entries, pending_cache_keys = [], []
 
-    successfully_captioned_count = len(results)
+    return PreparedChunk(chunk, captions, errors, pending_entries, pending_cache_keys, pixel_values)
 
-    # Construct an informative summary message based on the processing outcome.
-    if successfully_captioned_count == total_images_found and total_images_found > 0:
-        message = f"Successfully generated captions for all {total_images_found} found image(s)."
-    elif successfully_captioned_count > 0:
-        message = f"Generated captions for {successfully_captioned_count} out of {total_images_found} found image(s). See errors for details on failures."
-    elif total_images_found > 0 and successfully_captioned_count == 0:  # Found images, but none succeeded
-        message = f"Attempted to process {total_images_found} image(s), but no captions were successfully generated. See errors for details."
-    else:  # Should be covered by the initial check for total_images_found == 0
-        message = "No images were processed or found."
 
-    if not errors and successfully_captioned_count < total_images_found and total_images_found > 0:
-        # This case might indicate an issue in error reporting if some images failed silently.
-        additional_info = " Some images may have failed processing without explicit error messages being captured in the error list."
-        message += additional_info
-        logger.warning(
-            f"Discrepancy: {total_images_found} images found, {successfully_captioned_count} captioned, but no errors recorded.")
+async def prepare_chunks(image_entries: List[os.DirEntry], prepared_queue: "asyncio.Queue[Optional[PreparedChunk]]"):
+    """
+    Producer task: prepares chunks of CAPTION_BATCH_SIZE files and puts them on `prepared_queue`,
+    followed by a None sentinel. The bounded queue keeps at most PREFETCH_BATCHES chunks ahead of generation.
+    The sentinel is also sent before an exception propagates, but not on cancellation, when nobody is left
+    to consume it.
+
+    Args:
+        image_entries (List[os.DirEntry]): The image files to caption.
+        prepared_queue (asyncio.Queue): Queue consumed by `caption_folder_stream`.
+    """
+    try:
+        for chunk_start in range(0, len(image_entries), CAPTION_BATCH_SIZE):
+            await prepared_queue.put(await prepare_chunk(image_entries[chunk_start:chunk_start + CAPTION_BATCH_SIZE]))
+    except Exception:
+        await prepared_queue.put(None)
+        raise
+    await prepared_queue.put(None)
+
 
-    return CaptionSummaryResponse(
+async def caption_folder_stream(folder_path: str, image_entries: List[os.DirEntry]) -> AsyncIterator[str]:
+    """
+    Captions the given image files chunk by chunk and yields one NDJSON line per captioned image,
+    followed by a final summary line with counts and errors.
+
+    Chunks of CAPTION_BATCH_SIZE files are read, cache-checked, decoded and preprocessed by a background
+    producer task (`prepare_chunks`) while the previous chunk is being captioned, so CPU-side preparation
+    overlaps with generation. Lines are yielded in directory order as soon as their chunk completes.
+
+    Args:
+        folder_path (str): The folder being processed, as given in the request.
+        image_entries (List[os.DirEntry]): The image files to caption.
+
+    Yields:
+        str: NDJSON lines: `ImageCaptionResponseItem`s, then one `CaptionSummaryResponse`.
+    """
+    total_images_found = len(image_entries)
+    successfully_captioned_count = 0
+    errors: List[str] = []
+
+    prepared_queue: "asyncio.Queue[Optional[PreparedChunk]]" = asyncio.Queue(maxsize=PREFETCH_BATCHES)
+    producer = asyncio.create_task(prepare_chunks(image_entries, prepared_queue))
+    try:
+        while (prepared := await prepared_queue.get()) is not None:
+            errors.extend(prepared.errors)
+            chunk_captions = dict(prepared.captions)
+
+            if prepared.pixel_values is not None:
+                logger.info(f"Attempting to generate captions for {len(prepared.pending_entries)} image(s)...")
+                try:
+                    captions = await asyncio.get_running_loop().run_in_executor(
+                        _generate_pool, generate_from_pixel_values, prepared.pixel_values)
+                except Exception as e:
+                    logger.error(f"An error occurred during batched caption generation: {e}.", exc_info=True)
+                    for entry in prepared.pending_entries:
+                        errors.append(f"{entry.name}: An error occurred during caption generation for '{entry.name}': {e}.")
+                    captions = []
+
+                # The captions are returned one per input image, in order.
+                for entry, cache_key, generated_text in zip(prepared.pending_entries, prepared.pending_cache_keys,
+                                                            captions):
+                    if not generated_text:
+                        msg = f"Captioner returned an empty caption for '{entry.name}'. Skipping."
+                        logger.warning(msg)
+                        errors.append(f"{entry.name}: {msg}")
+                        continue
+                    logger.info(f"Generated Caption for '{entry.name}':\n{generated_text}\n")
+                    put_cached_caption(cache_key, generated_text)
+                    chunk_captions[entry.path] = generated_text
+
+            for entry in prepared.entries:
+                if entry.path in chunk_captions:
+                    successfully_captioned_count += 1
+                    yield to_ndjson_line(ImageCaptionResponseItem(image_path=entry.path,
+                                                                  description=chunk_captions[entry.path]))
+    finally:
+        # Stop preparing further chunks if the client disconnected mid-stream, then collect the producer's outcome.
+        producer.cancel()
+        try:
+            with suppress(asyncio.CancelledError):
+                await producer
+        except Exception as e:
+            logger.error(f"An error occurred while preparing images: {e}.", exc_info=True)
+            errors.append(f"An error occurred while preparing images: {e}.")
+
+    yield to_ndjson_line(CaptionSummaryResponse(
         total_images_found=total_images_found,
         successfully_captioned=successfully_captioned_count,
-        results=results,
-        message=message,
+        message=build_summary_message(folder_path, total_images_found, successfully_captioned_count, errors),
         errors=errors
-    )
+    ))
+
+
+# --- API Endpoint Definition ---
+@app.post("/caption-images/")
+async def create_captions_for_images_in_folder(request: ImageCaptionRequest):
+    """
+    FastAPI endpoint to process images in a given folder and generate captions.
+
+    Captions are streamed back as newline-delimited JSON as soon as each batch completes: one
+    `ImageCaptionResponseItem` line per captioned image, followed by a `CaptionSummaryResponse` line.
+
+    Args:
+        request (ImageCaptionRequest): The request body containing the 'folder_location'.
+
+    Raises:
+        HTTPException:
+            - 503 Service Unavailable: If the captioning model failed to load.
+            - 400 Bad Request: If the provided folder_location is invalid.
+            - 500 Internal Server Error: If there's an issue reading the directory.
+
+    Returns:
+        StreamingResponse: An `application/x-ndjson` stream of captions followed by a summary line.
+    """
+    if model is None or processor is None or generate_fn is None:
+        logger.error("Captioning model is not available. Initialization might have failed during startup.")
+        raise HTTPException(status_code=503, detail="Captioning service is unavailable. Model not loaded.")
+
+    folder_path = request.folder_location
+    logger.info(f"Received request to caption images in folder: {folder_path}")
+
+    if not os.path.isdir(folder_path):
+        logger.error(f"Invalid folder path provided: '{folder_path}' does not exist or is not a directory.")
+        raise HTTPException(status_code=400, detail=f"The folder '{folder_path}' does not exist or is not a directory.")
+
+    try:
+        # Listing a large folder is blocking filesystem work, so keep it off the event loop.
+        image_entries = await asyncio.get_running_loop().run_in_executor(_io_pool, list_image_entries, folder_path)
+    except OSError as e:
+        logger.error(f"Error listing directory {folder_path}: {e}")
+        raise HTTPException(status_code=500, detail=f"Could not read directory contents: {folder_path}")
+
+    if image_entries:
+        logger.info(f"Found {len(image_entries)} image(s) with supported extensions to process in folder: {folder_path}")
+        logger.info(f"Using generation parameters for captions: {GENERATION_ARGS}")
+    else:
+        logger.info(f"No images with supported extensions {SUPPORTED_EXTENSIONS} found in the folder: {folder_path}")
 
+    return StreamingResponse(caption_folder_stream(folder_path, image_entries), media_type="application/x-ndjson")
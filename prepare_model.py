@@ -0,0 +1,49 @@
+# prepare_model.py
+"""
+One-time model preparation utilities for the Image Captioning API.
+
+Usage:
+    python prepare_model.py safetensors [--output blip_st]
+
+`safetensors` saves a local snapshot of MODEL_NAME (weights in safetensors format plus the processor)
+that main.py loads through the CAPTION_MODEL_SNAPSHOT setting instead of the Hugging Face cache.
+"""
+import argparse
+import logging
+
+from config import MODEL_NAME, MODEL_SNAPSHOT_DIR
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def save_safetensors_snapshot(output_dir: str) -> None:
+    """
+    Saves MODEL_NAME and its processor to `output_dir`, with the weights in safetensors format.
+
+    Args:
+        output_dir (str): Destination directory for the snapshot.
+    """
+    from transformers import AutoProcessor, BlipForConditionalGeneration
+
+    logger.info(f"Saving a safetensors snapshot of {MODEL_NAME} to {output_dir}...")
+    model = BlipForConditionalGeneration.from_pretrained(MODEL_NAME)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    AutoProcessor.from_pretrained(MODEL_NAME).save_pretrained(output_dir)
+    logger.info(f"Snapshot written to {output_dir}.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Prepare model artifacts for the Image Captioning API.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    safetensors_parser = subparsers.add_parser("safetensors", help="Save a local safetensors snapshot of the model.")
+    safetensors_parser.add_argument("--output", default=MODEL_SNAPSHOT_DIR, help="Output directory for the snapshot.")
+
+    args = parser.parse_args()
+    if args.command == "safetensors":
+        save_safetensors_snapshot(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# tests/test_early_stopping.py
+"""Tests for the confident-EOS stopping criterion, on synthetic scores and on a tiny random BLIP model."""
+import os
+import sys
+
+import pytest
+import torch
+from transformers import BlipConfig, BlipForConditionalGeneration
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+from main import ConfidentEOSCriteria, LastScoresRecorder  # noqa: E402
+
+EOS = 2
+VOCAB = 5
+NUM_BEAMS = 3
+# Beam search evaluates stopping criteria on the top 2 * num_beams candidate continuations of each image.
+CANDIDATES = 2 * NUM_BEAMS
+MARGIN = 3.0
+
+
+def make_scores(best_beam_log_probs):
+    """Builds (num_images * NUM_BEAMS, VOCAB) scores; beam 0 of image i gets row i, the other beams favour EOS."""
+    rows = []
+    for log_probs in best_beam_log_probs:
+        rows.append(torch.tensor(log_probs))
+        # Non-best beams always look confidently finished, so only beam 0 may decide.
+        rows.extend(torch.tensor([-10.0, -10.0, 0.0, -10.0, -10.0]) for _ in range(NUM_BEAMS - 1))
+    return torch.stack(rows)
+
+
+def make_candidates(best_candidate_tokens):
+    """Builds (num_images * CANDIDATES, 4) candidate sequences; the first candidate of image i ends with token i."""
+    candidates = torch.zeros(len(best_candidate_tokens), CANDIDATES, 4, dtype=torch.long)
+    candidates[:, 1:, -1] = 1
+    candidates[:, 0, -1] = torch.tensor(best_candidate_tokens)
+    return candidates.view(-1, 4)
+
+
+def run_criteria(scores, candidates):
+    recorder = LastScoresRecorder()
+    criteria = ConfidentEOSCriteria(EOS, NUM_BEAMS, MARGIN, recorder)
+    # The recorder sees the running beams' processed scores before the candidates are selected.
+    assert torch.equal(recorder(torch.zeros(scores.shape[0], 3, dtype=torch.long), scores), scores)
+    return criteria(candidates, None)
+
+
+def test_confident_eos_stops_every_candidate():
+    done = run_criteria(make_scores([[-10.0, -9.0, -0.1, -8.0, -10.0]]), make_candidates([EOS]))
+    assert done.dtype == torch.bool
+    assert done.tolist() == [True] * CANDIDATES
+
+
+def test_small_margin_does_not_stop():
+    done = run_criteria(make_scores([[-10.0, -1.5, -0.1, -8.0, -10.0]]), make_candidates([EOS]))
+    assert done.tolist() == [False] * CANDIDATES
+
+
+def test_non_eos_top_token_does_not_stop():
+    done = run_criteria(make_scores([[-10.0, -0.1, -9.0, -8.0, -10.0]]), make_candidates([EOS]))
+    assert done.tolist() == [False] * CANDIDATES
+
+
+def test_non_eos_best_candidate_does_not_stop():
+    done = run_criteria(make_scores([[-10.0, -9.0, -0.1, -8.0, -10.0]]), make_candidates([1]))
+    assert done.tolist() == [False] * CANDIDATES
+
+
+def test_decision_is_per_image():
+    done = run_criteria(make_scores([
+        [-10.0, -9.0, -0.1, -8.0, -10.0],  # confident EOS
+        [-0.1, -9.0, -5.0, -8.0, -10.0],  # still writing
+    ]), make_candidates([EOS, 1]))
+    assert done.tolist() == [True] * CANDIDATES + [False] * CANDIDATES
+
+
+@pytest.mark.parametrize("recorded", [None, torch.zeros(NUM_BEAMS * 2 - 1, VOCAB)])
+def test_missing_or_mismatched_scores_do_not_stop(recorded):
+    recorder = LastScoresRecorder()
+    recorder.last_scores = recorded
+    criteria = ConfidentEOSCriteria(EOS, NUM_BEAMS, MARGIN, recorder)
+    assert criteria(make_candidates([EOS]), None).tolist() == [False] * CANDIDATES
+
+
+def test_generate_stops_earlier(monkeypatch):
+    torch.manual_seed(0)
+    config = BlipConfig(
+        text_config=dict(vocab_size=100, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=2, bos_token_id=5, sep_token_id=3, pad_token_id=0,
+                         encoder_hidden_size=32),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2,
+                           image_size=32, patch_size=8))
+    model = BlipForConditionalGeneration(config).eval()
+    with torch.no_grad():
+        # Make [SEP] (BLIP's EOS) the confident first prediction of every beam.
+        model.text_decoder.cls.predictions.bias[config.text_config.sep_token_id] = 4.0
+    decoder_calls = []
+    model.text_decoder.register_forward_hook(lambda *args: decoder_calls.append(1))
+    pixel_values = torch.randn(2, 3, 32, 32)
+
+    monkeypatch.setattr(main, "EOS_MARGIN", 1.0)
+    early_stopping_kwargs = main.build_early_stopping_kwargs(model)
+    assert early_stopping_kwargs
+
+    baseline = model.generate(pixel_values=pixel_values, **main.GENERATION_ARGS)
+    baseline_calls, decoder_calls[:] = len(decoder_calls), []
+    stopped = model.generate(pixel_values=pixel_values, **main.GENERATION_ARGS, **early_stopping_kwargs)
+
+    assert len(decoder_calls) < baseline_calls
+    # The EOS hypothesis is kept: the captions are unchanged.
+    assert torch.equal(stopped, baseline)
+    assert (stopped[:, -1] == config.text_config.sep_token_id).all()